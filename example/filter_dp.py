@@ -16,10 +16,11 @@ import vcflib
 
 def filter_vcf(in_vcf, out_vcf, min_dp=10):
     """ Filter variants in the input VCF with a INFO/DP < min_dp """
+    emit = out_vcf.emit  # Look up the bound method once, outside the loop
     for variant in in_vcf:
-        dp = variant.info.get("DP", None)  # INFO fields are stored as a dict
+        dp = variant.info.get("DP")  # INFO fields are stored as a dict
         if dp is not None and dp >= min_dp:
-            out_vcf.emit(variant)
+            emit(variant)
     return
 
 
@@ -52,7 +53,8 @@ def main(argv=None):
     args = parse_args(argv)
 
     assert os.path.isfile(args.input_vcf)
-    in_vcf = vcflib.VCF(str(args.input_vcf))
+    # Variants are written back unchanged, keep their bytes for reuse
+    in_vcf = vcflib.VCF(str(args.input_vcf), keep_raw=True)
     # `VCF()` accepts an option mode argument. Behavior is similar to mode in `open()`
     out_vcf = vcflib.VCF(str(args.output_vcf), "wb")
     out_vcf.copy_header(
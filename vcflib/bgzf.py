@@ -1,20 +1,84 @@
 # Copyright (c) 2014-2024 Sentieon Inc. All rights reserved
+import collections
 import io
+import mmap
+import os
 import struct
 import zlib
 
-from .compat import *
+try:
+    import deflate
+    from deflate import crc32
+except ImportError:
+    deflate = None
+    from zlib import crc32
 
 __all__ = ['BGZFile', 'open']
 
-def open(file, mode='rb'):
-    return BGZFile(file, mode)
+def open(file, mode='rb', threads=None):
+    return BGZFile(file, mode, threads)
+
+def compress(data, level):
+    if deflate is not None and level != 0:
+        # libdeflate levels are 1-12, with 6 being the zlib default
+        return deflate.deflate_compress(data, level if level > 0 else 6)
+    zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return zobj.compress(data) + zobj.flush(zlib.Z_FINISH)
+
+def decompress(data, size):
+    if deflate is not None:
+        return deflate.deflate_decompress(data, size)
+    return zlib.decompress(data, -zlib.MAX_WBITS, BGZFile.max_block_size)
+
+def inflate(data, size):
+    block = decompress(data, size)
+    if len(block) != size:
+        raise IOError('Incorrect block size')
+    return block
+
+def inflate_file(name):
+    # decode a whole (small) BGZF file in one go, straight from a mapping
+    # of the compressed file into a buffer preallocated from the ISIZEs
+    with io.open(name, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            # nothing to map, same as reading an empty stream
+            return bytearray()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as mv:
+                blocks, off, total = [], 0, 0
+                while off < len(mv):
+                    if off + 18 > len(mv):
+                        raise IOError('Incorrect header size')
+                    length = struct.unpack_from('<H', mv, off+16)[0] + 1
+                    if off + length > len(mv):
+                        raise IOError('Incorrect block size')
+                    size, = struct.unpack_from('<L', mv, off+length-4)
+                    if size > BGZFile.max_block_size:
+                        raise IOError('Incorrect block size')
+                    blocks.append((off, length, size))
+                    off += length
+                    total += size
+                buf = bytearray(total)
+                pos = 0
+                for off, length, size in blocks:
+                    if size:
+                        body = mv[off+18:off+length-8]
+                        try:
+                            buf[pos:pos+size] = inflate(body, size)
+                        finally:
+                            # a live slice would keep the mapping from
+                            # closing and mask the inflate error
+                            body.release()
+                        pos += size
+    return buf
 
 class BGZFile(io.IOBase):
     block_size = 65280
     max_block_size = 65536
+    buffer_size = 131072
+    BLOCK_HEADER = b'\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0'
 
-    def __init__(self, file, mode=None):
+    def __init__(self, file, mode=None, threads=None):
         level = zlib.Z_DEFAULT_COMPRESSION
         if mode is not None:
             for c in mode:
@@ -26,10 +90,10 @@ class BGZFile(io.IOBase):
         self.name = None
         self.file = None
 
-        if isinstance(file, basestring):
+        if isinstance(file, str):
             self.name = file
             mode = mode and 'b' not in mode and mode + 'b' or mode or 'rb'
-            self.file = io.open(file, mode)
+            self.file = io.open(file, mode, self.buffer_size)
         elif file is not None:
             self.file = file
             self.name = getattr(file, 'name', None)
@@ -37,13 +101,29 @@ class BGZFile(io.IOBase):
         else:
             raise ValueError('File object cannot be None')
 
+        self.pool = None
+        self.fd = None
         if mode[0:1] == 'r':
             self.mode = 0
             self.block = None
+            self.rbuf = b''
+            self.rbufoff = 0
+            if self.name == file and hasattr(os, 'pread'):
+                # positional reads on our own descriptor, no seek needed
+                self.fd = self.file.fileno()
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if threads is not None and threads > 1:
+                # decompress the next few blocks in the background
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(threads)
+                self.ahead = collections.deque()
+                self.nahead = threads * 2
+                self.rdoff = 0
         elif mode[0:1] == 'w':
             self.mode = 1
             self.zobj = None
-            self.block = b''
+            self.block = bytearray()
         else:
             raise IOError('Mode ' + mode + ' not supported')
 
@@ -71,7 +151,7 @@ class BGZFile(io.IOBase):
 
     def read(self, size=-1):
         self._checkReadable()
-        data = bytearray()
+        parts = []
         blk = self.pos >> 16
         off = self.pos & 65535
         while size != 0:
@@ -81,7 +161,7 @@ class BGZFile(io.IOBase):
             end = len(self.block)
             if size > 0:
                 end = min(end, off + size)
-            data += self.block[off:end]
+            parts.append(memoryview(self.block)[off:end])
             size -= end - off
             if end < len(self.block):
                 off = end
@@ -89,11 +169,11 @@ class BGZFile(io.IOBase):
             blk = self.blkend
             off = 0
         self.pos = blk << 16 | off
-        return bytes(data)
+        return b''.join(parts)
 
     def read_until(self, delim, size=-1):
         self._checkReadable()
-        data = bytearray()
+        parts = []
         blk = self.pos >> 16
         off = self.pos & 65535
         while size != 0:
@@ -105,7 +185,7 @@ class BGZFile(io.IOBase):
                 end = min(end, off + size)
             eos = self.block.find(delim, off, end)
             if eos >= 0: end = eos+1
-            data += self.block[off:end]
+            parts.append(memoryview(self.block)[off:end])
             size -= end - off
             if end < len(self.block):
                 off = end
@@ -115,13 +195,22 @@ class BGZFile(io.IOBase):
             if eos >= 0:
                 break
         self.pos = blk << 16 | off
-        return bytes(data)
+        return b''.join(parts)
 
     def readline(self, size=-1):
+        if (size < 0 and self.block is not None and self.mode == 0 and
+            self.blkoff == self.pos >> 16):
+            # fast path for a line that ends within the current block
+            off = self.pos & 65535
+            eos = self.block.find(b'\n', off) + 1
+            if 0 < eos < len(self.block):
+                self.pos = self.blkoff << 16 | eos
+                return bytes(memoryview(self.block)[off:eos])
         return self.read_until(b'\n', size)
 
     def write(self, data):
         self._checkWritable()
+        data = memoryview(data)
         ptr, size = 0, len(data)
         while ptr < size:
             n = min(self.block_size - len(self.block), size - ptr)
@@ -145,6 +234,11 @@ class BGZFile(io.IOBase):
         if self.mode == 1:
             self.flush()
             self._write_eof()
+        if self.pool is not None:
+            while self.ahead:
+                self.ahead.popleft()[2].cancel()
+            self.pool.shutdown()
+            self.pool = None
         self.file.close()
         self.file = None
 
@@ -153,40 +247,81 @@ class BGZFile(io.IOBase):
         return self.file is None
 
     def _read_block(self, offset):
-        self.file.seek(offset)
-        header = self.file.read(18)
-        if len(header) == 0:
+        if self.pool is not None:
+            return self._read_ahead(offset)
+        blk = self._fetch_block(offset)
+        if blk is None:
             return False
-        if len(header) != 18:
-            raise IOError('Incorrect header size')
-        length = struct.unpack('<H', header[16:18])[0] + 1
-        body = self.file.read(length-18-8)
-        crc, size = struct.unpack('<LL', self.file.read(8))
-        zobj = zlib.decompressobj(-zlib.MAX_WBITS)
-        self.block = zobj.decompress(body, self.max_block_size) + zobj.flush()
-        if len(self.block) != size:
-            raise IOError('Incorrect block size')
+        body, size, length = blk
+        self.block = inflate(body, size)
+        self.blkoff = offset
+        self.blkend = offset + length
+        return True
+
+    def _read_ahead(self, offset):
+        q = self.ahead
+        if not q or q[0][0] != offset:
+            while q:
+                q.popleft()[2].cancel()
+            self.rdoff = offset
+        while len(q) < self.nahead:
+            blk = self._fetch_block(self.rdoff)
+            if blk is None:
+                break
+            body, size, length = blk
+            q.append((self.rdoff, length, self.pool.submit(inflate, body, size)))
+            self.rdoff += length
+        if not q:
+            return False
+        offset, length, fut = q.popleft()
+        self.block = fut.result()
         self.blkoff = offset
         self.blkend = offset + length
-        zobj = None
         return True
 
+    def _read_at(self, offset, size):
+        # serve the read from the last window, or read a new one there
+        off = offset - self.rbufoff
+        if off < 0 or off + size > len(self.rbuf):
+            n = max(size, self.buffer_size)
+            if self.fd is not None:
+                self.rbuf = os.pread(self.fd, n, offset)
+            else:
+                self.file.seek(offset)
+                self.rbuf = self.file.read(n)
+            self.rbufoff = offset
+            off = 0
+        return memoryview(self.rbuf)[off:off+size]
+
+    def _fetch_block(self, offset):
+        header = self._read_at(offset, 18)
+        if len(header) == 0:
+            return None
+        if len(header) != 18:
+            raise IOError('Incorrect header size')
+        # BSIZE covers the whole block, take it from the window in one go
+        length = struct.unpack_from('<H', header, 16)[0] + 1
+        data = self._read_at(offset, length)
+        if len(data) != length:
+            raise IOError('Incorrect block size')
+        body = data[18:-8]
+        crc, size = struct.unpack_from('<LL', data, length-8)
+        if size > self.max_block_size:
+            raise IOError('Incorrect block size')
+        return body, size, length
+
     def _write_block(self):
-        zobj = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
-        body = zobj.compress(self.block) + zobj.flush(zlib.Z_FINISH)
+        body = compress(self.block, self.level)
         length = len(body)+18+8
-        crc = zlib.crc32(self.block) & 0xffffffff
-        self.file.write(b'\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0')
-        self.file.write(struct.pack('<H', length-1))
-        self.file.write(body)
-        self.file.write(struct.pack('<LL', crc, len(self.block)))
-        self.block = b''
+        crc = crc32(self.block) & 0xffffffff
+        self.file.write(b''.join((self.BLOCK_HEADER,
+            struct.pack('<H', length-1), body,
+            struct.pack('<LL', crc, len(self.block)))))
+        del self.block[:]
         self.blkoff += length
         self.blkend = self.blkoff
-        zobj = None
 
     def _write_eof(self):
-        self.file.write(b'\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0')
-        self.file.write(b'\033\0\3\0\0\0\0\0\0\0\0\0')
+        self.file.write(self.BLOCK_HEADER + b'\033\0\3\0\0\0\0\0\0\0\0\0')
 
 # vim: ts=4 sw=4 expandtab
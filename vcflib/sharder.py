@@ -1,18 +1,13 @@
 # Copyright (c) 2014-2024 Sentieon Inc. All rights reserved
 from abc import ABCMeta, abstractmethod
-import copy
 import heapq
 import multiprocessing
 import operator
 import signal
 
-from .compat import *
-
 __all__ = ['Sharder', 'Shardable', 'ShardResult']
 
-class Shardable(object):
-    __metaclass__ = ABCMeta
-
+class Shardable(metaclass=ABCMeta):
     @abstractmethod
     def __shard__(self, cse):
         return None
@@ -21,9 +16,7 @@ class Shardable(object):
     def __accum__(self, cse, data):
         return None
 
-class ShardResult(object):
-    __metaclass__ = ABCMeta
-
+class ShardResult(metaclass=ABCMeta):
     @abstractmethod
     def __getdata__(self):
         return None
@@ -44,24 +37,30 @@ def accum(obj, data):
 
 def apply(arg):
     idx, shd, func, args, kwargs = arg
-    if not isinstance(shd, list) or isinstance(shd[0], basestring):
+    if not isinstance(shd, list) or isinstance(shd[0], str):
         shd = [shd]
     ret = []
     for cse in shd:
         av = [shard(o, cse) for o in args]
-        kw = dict((k, shard(o, cse)) for k,o in iteritems(kwargs))
+        kw = dict((k, shard(o, cse)) for k,o in kwargs.items())
         try:
             rv = func(*av, **kw)
         except:
             import traceback
             traceback.print_exc()
             raise
-        rv = copy.deepcopy(rv)
-        av = [copy.deepcopy(getdata(o)) for o in av]
-        kw = dict((k, copy.deepcopy(getdata(o))) for k,o in iteritems(kw))
+        # results are pickled back to the parent, no need to copy them
+        av = [getdata(o) for o in av]
+        kw = dict((k, getdata(o)) for k,o in kw.items())
         ret.append((rv, av, kw))
     return (idx, shd, ret)
 
+def apply_batch(arg):
+    # a run of consecutive shards in one task, one result per shard
+    idx, shds, func, args, kwargs = arg
+    return [apply((idx+j, shd, func, args, kwargs))
+        for j, shd in enumerate(shds)]
+
 class Sharder(object):
     def __init__(self, nproc=None):
         self.nproc = nproc
@@ -77,13 +76,20 @@ class Sharder(object):
             reduce_fun, results = lambda s,x: s.append(x) or s, []
         else:
             results = reduce_fun(None)
-        tasks = ((i, shd, map_fun, args, kwargs) for i,shd in enumerate(shards))
+        shards = list(shards)
         q, idx = [], 0
+        nproc = self.nproc or multiprocessing.cpu_count()
+        # batch the shards ourselves, imap_unordered with a chunksize
+        # above 1 returns a plain generator without next(timeout)
+        n = max(1, len(shards) // (nproc * 4))
+        tasks = ((i, shards[i:i+n], map_fun, args, kwargs)
+            for i in range(0, len(shards), n))
         pool = multiprocessing.Pool(self.nproc, self.prep)
-        it = pool.imap_unordered(apply, tasks, chunksize=1)
+        it = pool.imap_unordered(apply_batch, tasks, chunksize=1)
         while True:
             try:
-                heapq.heappush(q, it.next(1))
+                for r in it.next(1):
+                    heapq.heappush(q, r)
                 while q and q[0][0] == idx:
                     i, shd, ret = heapq.heappop(q)
                     for rv, av, kw in ret:
@@ -91,7 +97,7 @@ class Sharder(object):
                             results = reduce_fun(results, rv)
                         for o,r in zip(args, av):
                             accum(o, r)
-                        for k,o in iteritems(kwargs):
+                        for k,o in kwargs.items():
                             accum(o, kw.get(k))
                     idx += 1
             except StopIteration:
@@ -112,41 +118,24 @@ class Sharder(object):
         shds = []
         size = 0
         for c,s,e in intvs:
-            while s < e:
-               n = min(e-s, step-size)
-               shds.append((c, s, s+n))
-               s += n
-               size += n
-               if size == step:
-                   yield shds
-                   shds = []
-                   size = 0
+            if size and s < e:
+                # top up the shard left over from the previous contigs
+                n = min(e-s, step-size)
+                shds.append((c, s, s+n))
+                s += n
+                size += n
+                if size == step:
+                    yield shds
+                    shds = []
+                    size = 0
+            if size == 0 and s < e:
+                m = s + (e-s) // step * step
+                for p in range(s, m, step):
+                    yield [(c, p, p+step)]
+                if m < e:
+                    shds.append((c, m, e))
+                    size = e - m
         if shds:
            yield shds
 
-if sys.version_info[0] == 2:
-    # allow pickling of instance methods
-    import copy_reg
-    import types
-
-    def _pickle_method(method):
-        func_name = method.im_func.__name__
-        obj = method.im_self
-        cls = method.im_class
-        return _unpickle_method, (func_name, obj, cls)
-
-    def _unpickle_method(func_name, obj, cls):
-        for cls in cls.mro():
-            try:
-                func = cls.__dict__[func_name]
-            except KeyError:
-                pass
-            else:
-                break
-        if obj is None:
-            return func
-        return func.__get__(obj, cls)
-
-    copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
-
 # vim: ts=4 sw=4 expandtab
@@ -1,14 +1,41 @@
 # Copyright (c) 2014-2024 Sentieon Inc. All rights reserved
+import array
+import bisect
 import collections
+import heapq
 import os
 import struct
 import sys
 
 from . import bgzf
-from .compat import *
 
 __all__ = ['Tabix']
 
+_S4 = struct.Struct('<L')
+_S8 = struct.Struct('<Q')
+_SH = struct.Struct('<6L')
+_STBI = struct.Struct('<L6LL')       # n_ref, aux header, l_nm
+_SCSI = struct.Struct('<3L')         # min_shift, depth, l_aux
+_SAUX = struct.Struct('<6LL')        # aux header, l_nm
+_SBIN = struct.Struct('<LL')         # bin, n_chunk
+_SBIN_CSI = struct.Struct('<LQL')    # bin, loffset, n_chunk
+
+_BIG_ENDIAN = sys.byteorder != 'little'
+
+def unpack_array(typecode, data, off, count):
+    # one C-level copy of count little-endian items out of data
+    a = array.array(typecode)
+    a.frombytes(data[off:off+count*a.itemsize])
+    if _BIG_ENDIAN:
+        a.byteswap()
+    return a
+
+def pack_array(a):
+    if _BIG_ENDIAN:
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
 class Header(object):
     __slots__ = ('format', 'col_seq', 'col_beg', 'col_end', 'meta', 'skip')
     def __init__(self, *args):
@@ -43,60 +70,62 @@ class Tabix(object):
             idxf = self.path + '.tbi'
             magic = self.TBI_MAGIC
 
-        with bgzf.open(idxf, 'rb') as fp:
-            s4 = struct.Struct('<L')
-            s8 = struct.Struct('<Q')
-            sh = struct.Struct('<6L')
-            data = fp.read(); off = 0
-            self.magic, = s4.unpack_from(data, off); off += s4.size
-            if self.magic != magic:
-                raise RuntimeError('Not a tabix file')
-            if self.magic == self.TBI_MAGIC:
-                self.min_shift, self.depth = 14, 5
-                n_ref, = s4.unpack_from(data, off); off += s4.size
-                aux = sh.unpack_from(data, off); off += sh.size
-                l_nm, = s4.unpack_from(data, off); off += s4.size
-                names = data[off:off+l_nm].split(b'\0'); off += l_nm
-            else:
-                self.min_shift, = s4.unpack_from(data, off); off += s4.size
-                self.depth, = s4.unpack_from(data, off); off += s4.size
-                l_aux, = s4.unpack_from(data, off); off += s4.size
-                if l_aux < sh.size + s4.size:
-                    raise RuntimeError('Invalid header')
-                aux = sh.unpack_from(data, off); off += sh.size
-                l_nm, = s4.unpack_from(data, off); off += s4.size
-                names = data[off:off+l_nm].split(b'\0'); off += l_nm
-                off += l_aux - (sh.size + s4.size + l_nm)
-                n_ref, = s4.unpack_from(data, off); off += s4.size
-            if len(names) != n_ref+1 or len(names[-1]) != 0:
-                raise RuntimeError('Header sequence name length mismatch')
-            self.header = Header(*aux)
-            for i in xrange(n_ref):
-                bins = {}
-                n_bin, = s4.unpack_from(data, off); off += s4.size
-                for _ in xrange(n_bin):
-                    bin, = s4.unpack_from(data, off); off += s4.size
-                    if self.magic == self.TBI_MAGIC:
-                        loffset = 0
-                    else:
-                        loffset, = s8.unpack_from(data, off); off += s8.size
-                    chunks = []
-                    n_chunk, = s4.unpack_from(data, off); off += s4.size
-                    for _ in xrange(n_chunk):
-                        s, = s8.unpack_from(data, off); off += s8.size
-                        e, = s8.unpack_from(data, off); off += s8.size
-                        chunks.append((s, e))
-                    bins[bin] = (loffset, chunks)
-                intvs = []
+        data = memoryview(bgzf.inflate_file(idxf)); off = 0
+        self.magic, = _S4.unpack_from(data, off); off += _S4.size
+        if self.magic != magic:
+            raise RuntimeError('Not a tabix file')
+        if self.magic == self.TBI_MAGIC:
+            self.min_shift, self.depth = 14, 5
+            n_ref, *aux, l_nm = _STBI.unpack_from(data, off)
+            off += _STBI.size
+            names = str(data[off:off+l_nm], 'utf-8').split('\0'); off += l_nm
+        else:
+            self.min_shift, self.depth, l_aux = _SCSI.unpack_from(data, off)
+            off += _SCSI.size
+            if l_aux < _SAUX.size:
+                raise RuntimeError('Invalid header')
+            *aux, l_nm = _SAUX.unpack_from(data, off); off += _SAUX.size
+            names = str(data[off:off+l_nm], 'utf-8').split('\0'); off += l_nm
+            off += l_aux - (_SAUX.size + l_nm)
+            n_ref, = _S4.unpack_from(data, off); off += _S4.size
+        if len(names) != n_ref+1 or len(names[-1]) != 0:
+            raise RuntimeError('Header sequence name length mismatch')
+        self.header = Header(*aux)
+        for i in range(n_ref):
+            items = []
+            n_bin, = _S4.unpack_from(data, off); off += _S4.size
+            for _ in range(n_bin):
                 if self.magic == self.TBI_MAGIC:
-                    n_intv, = s4.unpack_from(data, off); off += s4.size
-                    for _ in xrange(n_intv):
-                        o, = s8.unpack_from(data, off); off += s8.size
-                        intvs.append(o)
-                    if n_intv == 0:
-                        intvs.append(0)
-                self.indices[names[i].decode()] = (bins, intvs)
-            self.max_shift = self.min_shift + self.depth * 3
+                    bin, n_chunk = _SBIN.unpack_from(data, off)
+                    off += _SBIN.size
+                    loffset = 0
+                else:
+                    bin, loffset, n_chunk = _SBIN_CSI.unpack_from(data, off)
+                    off += _SBIN_CSI.size
+                items.append((bin, loffset, off, n_chunk))
+                off += n_chunk * 2 * _S8.size
+            # bins sorted by id, with all their chunks in one flat array
+            items.sort()
+            keys = array.array('I')
+            loffs = array.array('Q')
+            coffs = array.array('Q', [0])
+            chunks = array.array('Q')
+            for bin, loffset, o, n_chunk in items:
+                keys.append(bin)
+                loffs.append(loffset)
+                chunks.frombytes(data[o:o+n_chunk*2*_S8.size])
+                coffs.append(len(chunks))
+            if _BIG_ENDIAN:
+                chunks.byteswap()
+            intvs = array.array('Q')
+            if self.magic == self.TBI_MAGIC:
+                n_intv, = _S4.unpack_from(data, off); off += _S4.size
+                intvs = unpack_array('Q', data, off, n_intv)
+                off += n_intv * _S8.size
+                if n_intv == 0:
+                    intvs.append(0)
+            self.indices[names[i]] = (keys, loffs, coffs, chunks, intvs)
+        self.init_levels()
 
     def save(self):
         if self.header is None:
@@ -113,39 +142,46 @@ class Tabix(object):
             idxf = self.path + '.csi'
 
         with bgzf.open(idxf, 'wb') as fp:
-            s4 = struct.Struct('<L')
-            s8 = struct.Struct('<Q')
-            sh = struct.Struct('<6L')
-            nms = b''.join(c.encode()+b'\0' for c,_ in iteritems(self.indices))
-            fp.write(s4.pack(self.magic))
+            nms = b''.join(c.encode()+b'\0' for c,_ in self.indices.items())
+            fp.write(_S4.pack(self.magic))
             if self.magic == self.TBI_MAGIC:
-                fp.write(s4.pack(len(self.indices)))
-                fp.write(sh.pack(*self.header))
-                fp.write(s4.pack(len(nms)))
+                fp.write(_S4.pack(len(self.indices)))
+                fp.write(_SH.pack(*self.header))
+                fp.write(_S4.pack(len(nms)))
                 fp.write(nms)
             else:
-                fp.write(s4.pack(self.min_shift))
-                fp.write(s4.pack(self.depth))
-                fp.write(s4.pack(sh.size + s4.size + len(nms)))
-                fp.write(sh.pack(*self.header))
-                fp.write(s4.pack(len(nms)))
+                fp.write(_S4.pack(self.min_shift))
+                fp.write(_S4.pack(self.depth))
+                fp.write(_S4.pack(_SH.size + _S4.size + len(nms)))
+                fp.write(_SH.pack(*self.header))
+                fp.write(_S4.pack(len(nms)))
                 fp.write(nms)
-                fp.write(s4.pack(len(self.indices)))
-            for c, (bins, intvs) in iteritems(self.indices):
-                fp.write(s4.pack(len(bins)))
-                for bin in sorted(bins.keys()):
-                    loffset, chunks = bins[bin]
-                    fp.write(s4.pack(bin))
-                    if self.magic != self.TBI_MAGIC:
-                        fp.write(s8.pack(loffset))
-                    fp.write(s4.pack(len(chunks)))
-                    for s,e in chunks:
-                        fp.write(s8.pack(s))
-                        fp.write(s8.pack(e))
-                if self.magic == self.TBI_MAGIC:
-                    fp.write(s4.pack(len(intvs)))
-                    for o in intvs:
-                        fp.write(s8.pack(o))
+                fp.write(_S4.pack(len(self.indices)))
+            tbi = self.magic == self.TBI_MAGIC
+            sb = tbi and _SBIN or _SBIN_CSI
+            for c, (keys, loffs, coffs, chunks, intvs) in self.indices.items():
+                # size the whole reference up front and pack into it
+                size = _S4.size + len(keys) * sb.size + len(chunks) * _S8.size
+                if tbi:
+                    size += _S4.size + len(intvs) * _S8.size
+                data = bytearray(size)
+                _S4.pack_into(data, 0, len(keys))
+                off = _S4.size
+                raw = memoryview(pack_array(chunks))
+                for j, bin in enumerate(keys):
+                    cs, ce = coffs[j] * _S8.size, coffs[j+1] * _S8.size
+                    if tbi:
+                        sb.pack_into(data, off, bin, (ce-cs) // 16)
+                    else:
+                        sb.pack_into(data, off, bin, loffs[j], (ce-cs) // 16)
+                    off += sb.size
+                    data[off:off+ce-cs] = raw[cs:ce]
+                    off += ce - cs
+                if tbi:
+                    _S4.pack_into(data, off, len(intvs))
+                    off += _S4.size
+                    data[off:] = pack_array(intvs)
+                fp.write(data)
         self.header = None
 
     def query(self, c, s, e):
@@ -153,40 +189,54 @@ class Tabix(object):
         ci = self.indices.get(c)
         if ci is None:
             return ranges
+        keys, loffs, coffs, chunks, intvs = ci
+        flat = array.array('Q')
         s = max(s, 0)
         i = s >> self.min_shift
-        minoff = ci[1][min(i,len(ci[1])-1)] if ci[1] else 0
-        for shift in range(self.max_shift, self.min_shift-3, -3):
-            bo = ((1 << self.max_shift - shift) - 1) // 7
+        minoff = intvs[min(i,len(intvs)-1)] if intvs else 0
+        # a region within one finest bin has a single bin on every level
+        narrow = s < e and (s ^ (e-1)) >> self.min_shift == 0
+        for shift, bo in reversed(self.levels):
             bs = bo + (s >> shift)
-            be = bo + (e-1 >> shift)
-            if not ci[1]:
-                for bi in xrange(bs, bo-1, -1):
-                    b = ci[0].get(bi)
-                    if b is not None:
-                        minoff = max(minoff, b[0])
-                        break
-            for bi in xrange(bs, be+1):
-                b = ci[0].get(bi)
-                if b is not None:
-                    ranges.extend(b[1])
+            # only visit the bins in [bs, be] that are actually present
+            lo = bisect.bisect_left(keys, bs)
+            if narrow:
+                hi = lo + (lo < len(keys) and keys[lo] == bs)
+            else:
+                be = bo + (e-1 >> shift)
+                hi = bisect.bisect_right(keys, be, lo)
+            if not intvs:
+                j = lo if lo < len(keys) and keys[lo] == bs else lo-1
+                if j >= 0 and keys[j] >= bo:
+                    minoff = max(minoff, loffs[j])
+            if lo < hi:
+                # the chunks of consecutive bins are contiguous
+                flat += chunks[coffs[lo]:coffs[hi]]
+        # build the (beg, end) tuples once, already clipped to minoff
         if minoff > 0:
-            ranges = [(max(s,minoff), e) for s,e in ranges if e > minoff]
-        return self.merge(ranges, 16)
+            ranges = [(s if s > minoff else minoff, e)
+                for s,e in zip(flat[0::2], flat[1::2]) if e > minoff]
+        else:
+            ranges = list(zip(flat[0::2], flat[1::2]))
+        # sort our own list in place rather than have merge copy it
+        ranges.sort()
+        return self.merge(ranges, 16, True)
 
     @staticmethod
-    def merge(ranges, shift):
-        p = None
-        for r in sorted(ranges):
-            if p is None:
-                p = r
-            elif r[0] >> shift > p[1] >> shift:
-                yield p
-                p = r
-            else:
-                p = (p[0], max(p[1],r[1]))
-        if p is not None:
-            yield p
+    def merge(ranges, shift, presorted=False):
+        it = iter(ranges if presorted else sorted(ranges))
+        for ps, pe in it:
+            break
+        else:
+            return
+        pb = pe >> shift
+        for s, e in it:
+            if s >> shift > pb:
+                yield (ps, pe)
+                ps, pe, pb = s, e, e >> shift
+            elif e > pe:
+                pe, pb = e, e >> shift
+        yield (ps, pe)
 
     def init(self):
         self.magic = self.TBI_MAGIC
@@ -199,13 +249,19 @@ class Tabix(object):
                 self.min_shift = type[1]
             if len(type) > 2:
                 self.depth = type[2]
-        self.max_shift = self.min_shift + self.depth * 3
+        self.init_levels()
         self.header = Header(self.FMT_VCF, 1, 2, 2, ord('#'), 0)
         self.indices = collections.OrderedDict()
         self.ci = None
         self.pos = 0
         self.end = 0
 
+    def init_levels(self):
+        self.max_shift = self.min_shift + self.depth * 3
+        # (shift, first bin id) of each level, from the finest to the root
+        self.levels = [(shift, ((1 << self.max_shift - shift) - 1) // 7)
+            for shift in range(self.min_shift, self.max_shift+3, 3)]
+
     def add(self, c, s, e, off):
         if c is None and s > 0:
             # s is the max contig length
@@ -219,29 +275,31 @@ class Tabix(object):
             if shift > self.min_shift + self.depth * 3:
                 self.magic = self.CSI_MAGIC;
                 self.depth = (shift - self.min_shift + 2) // 3;
-                self.max_shift = self.min_shift + self.depth * 3
+                self.init_levels()
         if self.ci and self.ci[0] != c:
             self.optimize(self.ci)
             self.ci = None
         if self.ci is None and c is not None:
-            self.ci = (c, {}, [])
+            self.ci = (c, {}, array.array('Q'), [])
             self.indices[c] = self.ci[1:]
             self.pos = 0
         if self.ci:
-            chrom, bins, intvs = self.ci
+            chrom, bins, intvs, keys = self.ci
             assert chrom == c and s >= self.pos
             be = e-1 >> self.min_shift
             if be >= len(intvs):
-                intvs += [self.end] * (be+1 - len(intvs))
-            bin = 0
-            for shift in range(self.min_shift, self.max_shift+3, 3):
-                bs, be = s >> shift, e-1 >> shift
-                if bs == be:
-                    bo = ((1 << self.max_shift - shift) - 1) // 7
-                    bin = bo + bs
-                    break
-            b = bins.setdefault(bin,[])
-            if not b: b.extend((0, []))
+                intvs.extend([self.end] * (be+1 - len(intvs)))
+            # the finest level whose shift clears every bit s and e-1 differ in
+            lvl = max(0, ((s ^ (e-1)).bit_length() - self.min_shift + 2) // 3)
+            if lvl < len(self.levels):
+                shift, bo = self.levels[lvl]
+                bin = bo + (s >> shift)
+            else:
+                bin = 0
+            b = bins.get(bin)
+            if b is None:
+                b = bins[bin] = [0, []]
+                bisect.insort(keys, bin)
             chunks = b[1]
             if chunks and chunks[-1][1] == self.end:
                 chunks[-1] = (chunks[-1][0], off)
@@ -251,14 +309,12 @@ class Tabix(object):
         self.end = off
 
     def optimize(self, ci):
-        bins = ci[1]
-        for shift in range(self.min_shift, self.max_shift+3, 3):
-            bo = ((1 << self.max_shift - shift) - 1) // 7
-            for bin in sorted(bins.keys()):
-                if bin < bo:
-                    continue
-                if bin > bo << 3:
-                    break
+        bins, keys = ci[1], ci[3]
+        for shift, bo in self.levels:
+            # the bins of this level, from the ids add() kept sorted
+            lo = bisect.bisect_left(keys, bo)
+            hi = bisect.bisect_right(keys, bo << 3, lo)
+            for bin in keys[lo:hi]:
                 b = bins.get(bin)
                 if b is None:
                     continue
@@ -271,12 +327,27 @@ class Tabix(object):
                 if be - bs < 65536 and bo > 0:
                     del bins[bin]
                     bin = bin-1 >> 3
-                    b = bins.setdefault(bin,[])
-                    if not b: b.extend((0, []))
-                    b[1] = list(self.merge(chunks + b[1], 16))
+                    b = bins.get(bin)
+                    if b is None:
+                        b = bins[bin] = [0, []]
+                        bisect.insort(keys, bin)
+                    # both lists are in file order already
+                    b[1] = list(self.merge(heapq.merge(chunks, b[1]), 16, True))
                 elif ci[2]:
                     intv = (bin - bo) << (shift - self.min_shift)
                     intv = min(intv, len(ci[2])-1)
                     b[0] = ci[2][intv]
+        # freeze the contig into the same flat layout load() produces
+        keys = array.array('I', [bin for bin in keys if bin in bins])
+        loffs = array.array('Q')
+        coffs = array.array('Q', [0])
+        chunks = array.array('Q')
+        for bin in keys:
+            loffset, bchunks = bins[bin]
+            loffs.append(loffset)
+            for r in bchunks:
+                chunks.extend(r)
+            coffs.append(len(chunks))
+        self.indices[ci[0]] = (keys, loffs, coffs, chunks, ci[2])
 
 # vim: ts=4 sw=4 expandtab
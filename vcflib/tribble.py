@@ -1,16 +1,33 @@
 # Copyright (c) 2014-2024 Sentieon Inc. All rights reserved
+import array
 import bisect
 import collections
-import heapq
 import io
+import itertools
+import mmap
 import os
 import struct
+import sys
 import time
 
-from .compat import *
-
 __all__ = ['TribbleIndex']
 
+_SI = struct.Struct('<i')
+_SII = struct.Struct('<ii')
+_SQQ = struct.Struct('<QQ')
+_SHDR = struct.Struct('<iii')        # magic, type, version
+_SLIN = struct.Struct('<iiiii')      # width, bins, longest, 0, count
+_SITV = struct.Struct('<iiQi')       # sloc, eloc, offset, size
+
+_BIG_ENDIAN = sys.byteorder != 'little'
+
+def unpack_cstr(data, off):
+    # NUL-terminated string at off, found in place instead of via a split
+    end = data.find(b'\0', off)
+    if end < 0:
+        raise RuntimeError('Unterminated string')
+    return data[off:end], end + 1
+
 class Header(object):
     __slots__ = ('magic', 'type', 'version', 'filename', 'filesize',
         'timestamp', 'md5', 'flags', 'properties')
@@ -19,34 +36,47 @@ class Header(object):
             setattr(self, k, v)
 
 class LinearIndex(object):
+    __slots__ = ('chrom', 'end', 'width', 'longest', 'count', 'blocks',
+        'density', 'limit')
     def __init__(self, chrom, off, width, density):
         self.chrom = chrom
         self.end = off
         self.width = width
         self.longest = 0
         self.count = 0
-        self.blocks = []
+        self.blocks = array.array('Q')
         self.density = density
+        self.limit = 0 # first position past the last bin in blocks
 
     def decode(self, data, off):
-        chrom,_ = data[off:].split(b'\0',1)
-        off += len(chrom) + 1
+        chrom, off = unpack_cstr(data, off)
         self.chrom = chrom.decode()
-        s = struct.Struct('<iiiii')
-        self.width, bins, self.longest, _, self.count = s.unpack_from(data, off)
-        off += s.size;
-        s = struct.Struct('<'+'Q'*(bins+1))
-        self.blocks = s.unpack_from(data, off)
-        off += s.size
+        self.width, bins, self.longest, _, self.count = \
+            _SLIN.unpack_from(data, off)
+        off += _SLIN.size
+        blocks = data[off:off+8*(bins+1)]
+        if len(blocks) != 8*(bins+1):
+            raise RuntimeError('Truncated index')
+        self.blocks = array.array('Q')
+        self.blocks.frombytes(blocks)
+        if _BIG_ENDIAN:
+            self.blocks.byteswap()
+        off += 8 * (bins+1)
         return off
 
     def encode(self):
-        data = bytearray()
-        data.extend(self.chrom.encode())
-        data.extend(b'\0')
-        data.extend(struct.pack('<iiiii', self.width,
-            len(self.blocks)-1, self.longest, 0, self.count))
-        data.extend(struct.pack('<'+'Q'*len(self.blocks), *self.blocks))
+        chrom = self.chrom.encode()
+        blocks = self.blocks
+        if _BIG_ENDIAN:
+            blocks = array.array('Q', blocks)
+            blocks.byteswap()
+        # chrom\0, header, blocks, packed into one presized buffer
+        off = len(chrom) + 1
+        data = bytearray(off + _SLIN.size + len(blocks) * 8)
+        data[:len(chrom)] = chrom
+        _SLIN.pack_into(data, off, self.width,
+            len(blocks)-1, self.longest, 0, self.count)
+        data[off+_SLIN.size:] = blocks.tobytes()
         return data
 
     def query(self, s, e):
@@ -57,10 +87,12 @@ class LinearIndex(object):
         return [(self.blocks[i], self.blocks[-1])]
 
     def add(self, s, e, off):
-        bin = s // self.width
-        if bin >= len(self.blocks):
-            self.blocks += [self.end] * (bin+1-len(self.blocks))
-        self.longest = max(self.longest, e-s)
+        if s >= self.limit:
+            bin = s // self.width
+            self.blocks.extend([self.end] * (bin+1-len(self.blocks)))
+            self.limit = (bin+1) * self.width
+        if e - s > self.longest:
+            self.longest = e - s
         self.count += 1
         self.end = off
 
@@ -70,12 +102,12 @@ class LinearIndex(object):
 
     def optimize(self):
         maxsize = max(self.blocks[i] - self.blocks[i-1]
-            for i in xrange(1, len(self.blocks)))
+            for i in range(1, len(self.blocks)))
         fullsize = self.blocks[-1] - self.blocks[0]
         scale = (self.density * fullsize) // (self.count * maxsize)
         if scale > 1:
             bins = (len(self.blocks)-1 + scale-1) // scale
-            self.blocks = [self.blocks[i*scale] for i in xrange(bins)]
+            self.blocks = self.blocks[:bins*scale:scale]
             self.width *= scale
 
 class IntervalTree(object):
@@ -89,28 +121,34 @@ class IntervalTree(object):
 
     def update(self):
         self.intvls.sort()
-        self.splits = []
-        self.values = []
-        cur, h = 0, []
+        self.splits = splits = []
+        self.values = values = []
+        # sweep the sorted starts against the ends, sorted on their own;
+        # the open intervals are kept in a dict, in the order they opened
+        ends = sorted((v[1], i) for i, v in enumerate(self.intvls))
+        cur, k, h = 0, 0, {}
         for i,v in enumerate(self.intvls):
-            while h and h[0][0] <= v[0]:
-                self.splits.extend((cur, h[0][0]))
-                self.values.append([j for _,j in h])
-                cur = heapq.heappop(h)[0]
+            while k < len(ends) and ends[k][0] <= v[0]:
+                e, j = ends[k]
+                if j >= i:
+                    # not open yet, only empty intervals like the sentinel
+                    break
+                splits.extend((cur, e))
+                values.append(list(h))
+                cur = e
+                del h[j]
+                k += 1
             if h and cur < v[0]:
-                self.splits.extend((cur, v[0]))
-                self.values.append([j for _,j in h])
+                splits.extend((cur, v[0]))
+                values.append(list(h))
             cur = v[0]
-            heapq.heappush(h, (v[1], i))
+            h[i] = None
 
     def query(self, s, e):
-        r = set()
-        i = bisect.bisect(self.splits, s) // 2
-        while i < len(self.values):
-            if e <= self.splits[i*2]:
-                break
-            r |= set(self.values[i])
-            i += 1
+        # segments [lo, hi) are the ones that end after s and start before e
+        lo = bisect.bisect(self.splits, s) // 2
+        hi = (bisect.bisect_left(self.splits, e, lo*2) + 1) // 2
+        r = set(itertools.chain.from_iterable(self.values[lo:hi]))
         return (self.intvls[i][2] for i in r)
 
 class IntervalTreeIndex(object):
@@ -121,31 +159,32 @@ class IntervalTreeIndex(object):
         self.curr = [0, 0, off, off, 0] # [sloc, eloc, soff, eoff, count]
 
     def decode(self, data, off):
-        chrom,_ = data[off:].split(b'\0',1)
-        off += len(chrom) + 1
+        chrom, off = unpack_cstr(data, off)
         self.chrom = chrom.decode()
-        s = struct.Struct('<i')
-        nitvs, = s.unpack_from(data, off)
-        off += s.size
-        s = struct.Struct('<iiQi')
-        for _ in xrange(nitvs):
-            sloc, eloc, boff, size = s.unpack_from(data, off)
-            off += s.size
-            self.tree.insert(sloc-1, eloc, (boff, boff+size))
+        nitvs, = _SI.unpack_from(data, off)
+        off += _SI.size
+        end = off + _SITV.size * nitvs
+        if end > len(data):
+            raise RuntimeError('Truncated index')
+        self.tree.intvls.extend((sloc-1, eloc, (boff, boff+size))
+            for sloc, eloc, boff, size in _SITV.iter_unpack(data[off:end]))
+        off = end
         self.tree.update()
         return off
 
     def encode(self):
-        data = bytearray()
-        data.extend(self.chrom.encode())
-        data.extend(b'\0')
-        s = struct.Struct('<i')
-        data.extend(s.pack(len(self.tree.intvls)-1))
-        s = struct.Struct('<iiQi')
+        chrom = self.chrom.encode()
+        nitvs = len(self.tree.intvls) - 1
+        off = len(chrom) + 1
+        data = bytearray(off + _SI.size + nitvs * _SITV.size)
+        data[:len(chrom)] = chrom
+        _SI.pack_into(data, off, nitvs)
+        off += _SI.size
         for sloc, eloc, b in self.tree.intvls:
             if b is None:
                 continue
-            data.extend(s.pack(sloc+1, eloc, b[0], b[1]-b[0]))
+            _SITV.pack_into(data, off, sloc+1, eloc, b[0], b[1]-b[0])
+            off += _SITV.size
         return data
 
     def query(self, s, e):
@@ -191,49 +230,42 @@ class TribbleIndex(object):
     def load(self):
         self.indices = collections.OrderedDict()
 
-        with io.open(self.path, 'rb') as fp:
-            data = fp.read()
+        with io.open(self.path, 'rb') as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
             off = 0
 
-            s = struct.Struct('<iii')
-            magic, type, version = s.unpack_from(data, off)
-            off += s.size
+            magic, type, version = _SHDR.unpack_from(data, off)
+            off += _SHDR.size
             if (magic != self.MAGIC or version != self.VERSION or
                 type != self.INDEX_TYPE_LINEAR and
                 type != self.INDEX_TYPE_INTERVAL_TREE):
                 raise RuntimeError('Bad magic/type/version')
 
-            file,_ = data[off:].split(b'\0',1)
-            off += len(file) + 1
+            file, off = unpack_cstr(data, off)
             file = file.decode()
 
-            s = struct.Struct('<QQ')
-            size,time = s.unpack_from(data, off)
-            off += s.size
+            size,time = _SQQ.unpack_from(data, off)
+            off += _SQQ.size
 
-            md5,_ = data[off:].split(b'\0',1)
-            off += len(md5) + 1
+            md5, off = unpack_cstr(data, off)
 
-            s = struct.Struct('<ii')
-            flags,nprop = s.unpack_from(data, off)
-            off += s.size
-            if nprop > 0:
-                t = data[off:].split(b'\0', 2*nprop)
-                if len(t) != 2*nprop+1:
+            flags,nprop = _SII.unpack_from(data, off)
+            off += _SII.size
+            t = []
+            for _ in range(2*nprop):
+                end = data.find(b'\0', off)
+                if end < 0:
                     raise RuntimeError('Incorrect property count')
-                data = t.pop(); off = 0
-                t = [s.decode() for s in t]
-                properties = zip(*[iter(t)]*2)
-            else:
-                properties = []
+                t.append(data[off:end].decode())
+                off = end + 1
+            properties = list(zip(t[0::2], t[1::2]))
 
             self.header = Header(magic, type, version, file,
                 size, time, md5, flags, properties)
 
-            s = struct.Struct('<i')
-            nchrs, = s.unpack_from(data, off)
-            off += s.size
-            for _ in xrange(nchrs):
+            nchrs, = _SI.unpack_from(data, off)
+            off += _SI.size
+            for _ in range(nchrs):
                 if type ==  self.INDEX_TYPE_LINEAR:
                     ci = LinearIndex('', 0, 0, 0)
                 elif type ==  self.INDEX_TYPE_INTERVAL_TREE:
@@ -249,16 +281,16 @@ class TribbleIndex(object):
         h.filesize = self.end
         h.timestamp = int(time.time())
         with io.open(self.path, 'wb') as fp:
-            fp.write(struct.pack('<iii', h.magic, h.type, h.version))
+            fp.write(_SHDR.pack(h.magic, h.type, h.version))
             fp.write(h.filename.encode()); fp.write(b'\0')
-            fp.write(struct.pack('<QQ', h.filesize, h.timestamp))
+            fp.write(_SQQ.pack(h.filesize, h.timestamp))
             fp.write(h.md5); fp.write(b'\0')
-            fp.write(struct.pack('<ii', h.flags, len(h.properties)))
+            fp.write(_SII.pack(h.flags, len(h.properties)))
             for k,v in h.properties:
                 fp.write(k.encode()); fp.write(b'\0')
                 fp.write(v.encode()); fp.write(b'\0')
-            fp.write(struct.pack('<i', len(self.indices)))
-            for k,ci in iteritems(self.indices):
+            fp.write(_SI.pack(len(self.indices)))
+            for k,ci in self.indices.items():
                 fp.write(ci.encode())
         self.header = None
 
@@ -270,17 +302,19 @@ class TribbleIndex(object):
 
     @staticmethod
     def merge(ranges, shift):
-        p = None
-        for r in sorted(ranges):
-            if p is None:
-                p = r
-            elif r[0] >> shift > p[1] >> shift:
-                yield p
-                p = r
-            else:
-                p = (p[0], max(p[1],r[1]))
-        if p is not None:
-            yield p
+        it = iter(sorted(ranges))
+        for ps, pe in it:
+            break
+        else:
+            return
+        pb = pe >> shift
+        for s, e in it:
+            if s >> shift > pb:
+                yield (ps, pe)
+                ps, pe, pb = s, e, e >> shift
+            elif e > pe:
+                pe, pb = e, e >> shift
+        yield (ps, pe)
 
     def init(self):
         type = int(os.getenv('VCF_INDEX_TYPE', '1'))
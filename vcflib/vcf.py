@@ -1,6 +1,7 @@
 # Copyright (c) 2014-2024 Sentieon Inc. All rights reserved
 import collections
 import fnmatch
+import functools
 import io
 import itertools
 import os
@@ -12,29 +13,66 @@ from . import bgzf
 from . import sharder
 from . import tabix
 from . import tribble
-from .compat import *
 
 __all__ = ['VCF', 'Variant']
 
+def cmp(x, y):
+    return (x > y) - (x < y)
+
+def decode_scalar(cvt, v):
+    return None if v == '.' else cvt(v)
+
+def decode_list(cvt, v):
+    if v == '.':
+        return None
+    v = v.split(',')
+    if all(x == '.' for x in v):
+        return None
+    return list(map(cvt, v))
+
+def encode_flag(v):
+    return '.' if v is None else None
+
+def encode_scalar(cvt, v):
+    return '.' if v is None else cvt(v)
+
+def encode_list(cvt, v):
+    return '.' if v is None else ','.join(map(cvt, v))
+
 class Variant(object):
     __slots__ = ('chrom', 'pos', 'id', 'ref', 'alt', 'qual', 'filter',
-        'info', 'samples', 'end', 'line')
-    def __init__(self, *args):
-        for k,v in izip(self.__slots__, args):
-            setattr(self, k, v)
+        'info', 'samples', 'end', 'line', 'raw')
+    def __init__(self, chrom=None, pos=None, id=None, ref=None, alt=None,
+        qual=None, filter=None, info=None, samples=None, end=None, line=None,
+        raw=None):
+        self.chrom = chrom
+        self.pos = pos
+        self.id = id
+        self.ref = ref
+        self.alt = alt
+        self.qual = qual
+        self.filter = filter
+        self.info = info
+        self.samples = samples
+        self.end = end
+        self.line = line
+        self.raw = raw # (line, its bytes as read) with VCF keep_raw
     def __str__(self):
         return self.line
 
 class VCF(sharder.Shardable):
     decoders = { 'Integer': int, 'Float': float, 'Flag': bool }
     encoders = { 'Integer': str, 'Float': str }
-    kvpat = re.compile(r'(.*?)=(".*?"|.*?)(?:,|$)') 
 
-    def __init__(self, path, mode='r'):
+    def __init__(self, path, mode='r', threads=None, keep_raw=False):
         self.path = path
         self.mode = 'b' not in mode and mode + 'b' or mode
+        self.threads = threads
+        # keep_raw holds on to the bytes of each record read, so that
+        # records written back unchanged skip the encode
+        self.keep_raw = keep_raw
         self.isGVCF = path.endswith('.g.vcf') or path.endswith('.g.vcf.gz')
-        self.open(self.path, self.mode)
+        self.open(self.path, self.mode, threads)
         if self.mode[0:1] == 'r':
             self.load_header()
             self.parse_header()
@@ -55,14 +93,15 @@ class VCF(sharder.Shardable):
         path = ndict['path']
         mode = ndict['mode']
         if mode[0:1] == 'r':
-            self.open(path, mode)
+            self.open(path, mode, ndict.get('threads'))
             self.fp.seek(ndict.pop('fp'))
         self.__dict__.update(ndict)
 
-    def open(self, path, mode):
+    def open(self, path, mode, threads=None):
+        # threads > 1 inflates the blocks of a bgzipped input ahead of use
         self.fp, self.index = None, None
         if path.endswith('.gz'):
-            self.fp = bgzf.open(path, mode)
+            self.fp = bgzf.open(path, mode, threads)
             self.index = tabix.Tabix(path, mode)
         elif path == '-':
             if mode[0:1] == 'r':
@@ -71,6 +110,9 @@ class VCF(sharder.Shardable):
         else:
             self.fp = io.open(path, mode)
             self.index = tribble.TribbleIndex(path, mode)
+            if mode[0:1] == 'r' and hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self.fp.fileno(), 0, 0,
+                    os.POSIX_FADV_SEQUENTIAL)
 
     def load_header(self):
         self.headers = []
@@ -83,37 +125,56 @@ class VCF(sharder.Shardable):
         self.fp.seek(offset)
         self.initoff = offset
 
+    @staticmethod
+    def split_header(line):
+        # (field, ID) of a ##field=<ID=...> line, as the regex
+        # ^##([^=]+)=(<ID=([^,]+).*>)? would match it, or None
+        if not line.startswith('##'):
+            return None
+        eq = line.find('=', 2)
+        if eq <= 2:
+            return None
+        fld, id = line[2:eq], None
+        if line.startswith('<ID=', eq+1):
+            s = eq + 5
+            c = line.find(',', s)
+            e = min(c if c >= 0 else len(line), line.rfind('>'))
+            if e > s:
+                id = line[s:e]
+        return fld, id
+
     def copy_header(self, src, update=None, remove=None):
         hdrs = collections.OrderedDict()
-        pat = re.compile(r'^##([^=]+)=(<ID=([^,]+).*>)?')
         for line in src.headers:
-            m = pat.match(line)
-            if m is None:
-                fld, id = line, None
-            else:
-                fld, id = m.group(1), m.group(3)
+            m = self.split_header(line)
+            fld, id = m or (line, None)
             hdrs.setdefault(fld, collections.OrderedDict())[id] = line
         if update:
             for line in update:
-                m = pat.match(line)
+                m = self.split_header(line)
                 if m is None:
                     continue
-                fld, id = m.group(1), m.group(3)
+                fld, id = m
                 hdrs.setdefault(fld, collections.OrderedDict())[id] = line
         if remove:
+            globs = collections.OrderedDict()
             for line in remove:
-                m = pat.match(line)
+                m = self.split_header(line)
                 if m is None:
                     continue
-                fld, id = m.group(1), m.group(3)
+                fld, id = m
                 if fld not in hdrs:
                     continue
                 if id is None:
                     if fnmatch.fnmatch(hdrs[fld].get(id,''), line):
                         hdrs[fld].pop(id)
                 else:
-                    for id in fnmatch.filter(hdrs[fld].keys(), id):
-                        hdrs[fld].pop(id)
+                    globs.setdefault(fld, []).append(fnmatch.translate(id))
+            # one regex per field for all of its ID globs, one pass over IDs
+            for fld, pats in globs.items():
+                match = re.compile('|'.join(pats)).match
+                for id in [k for k in hdrs[fld] if k is not None and match(k)]:
+                    hdrs[fld].pop(id)
         self.headers = [l for _,v in hdrs.items() for _,l in v.items()]
         self.parse_header()
 
@@ -129,9 +190,7 @@ class VCF(sharder.Shardable):
         line = '\t'.join(cols)
         self.fp.write(line.encode() + b'\n')
         if self.index is not None:
-            maxlen = max(int(t.get('length',0))
-                for c,t in iteritems(self.contigs))
-            self.index.add(None, maxlen, 0, self.fp.tell())
+            self.index.add(None, self.contig_maxlen, 0, self.fp.tell())
 
     def parse_header(self):
         self.contigs = collections.OrderedDict()
@@ -158,6 +217,21 @@ class VCF(sharder.Shardable):
                 self.formats[d['ID']] = d
             elif line.startswith('#CHROM'):
                 self.samples = line[1:].split('\t')[9:]
+        self.contig_order = dict((c, i) for i, c in enumerate(self.contigs))
+        self.contig_maxlen = max((int(t.get('length',0))
+            for t in self.contigs.values()), default=0)
+        self.info_decoders = dict((k, self.make_decoder(d))
+            for k,d in self.infos.items())
+        self.format_decoders = dict((k, self.make_decoder(d))
+            for k,d in self.formats.items())
+        self.format_scalar_cvts = dict((k, self.scalar_converter(d))
+            for k,d in self.formats.items())
+        self.info_encoders = dict((k, self.make_encoder(d))
+            for k,d in self.infos.items())
+        self.format_encoders = dict((k, self.make_encoder(d))
+            for k,d in self.formats.items())
+        self.key_orders = {}
+        self.format_keys = {}
 
     @staticmethod
     def parse_kv(kv):
@@ -168,14 +242,31 @@ class VCF(sharder.Shardable):
     def parse_line(line):
         s = line.index('<')
         e = line.index('>')
-        return dict(VCF.kvpat.findall(line[s+1:e]))
+        line = line[s+1:e]
+        d, i, n = {}, 0, len(line)
+        while True:
+            j = line.find('=', i)
+            if j < 0:
+                break
+            s = e = j + 1
+            if line.startswith('"', s):
+                # a quoted value ends at a quote followed by a comma or the end
+                e = line.find('"', s+1)
+                while e >= 0 and e+1 < n and line[e+1] != ',':
+                    e = line.find('"', e+1)
+                e = e >= 0 and e+1 or s
+            if e == s:
+                e = line.find(',', s)
+                if e < 0:
+                    e = n
+            d[line[i:j]] = line[s:e]
+            if e >= n:
+                break
+            i = e + 1
+        return d
 
     @staticmethod
-    def parse_field(desc, kv):
-        k,v = kv
-        d = desc.get(k)
-        if d is None:
-            return (k, v)
+    def parse_value(d, v):
         cvt = VCF.decoders.get(d['Type'], str)
         if v == '.':
             v = None
@@ -187,28 +278,96 @@ class VCF(sharder.Shardable):
                 v = list(map(cvt, v))
         elif cvt:
             v = cvt(v)
-        return (k,v)
+        return v
+
+    @staticmethod
+    def scalar_converter(d):
+        # the converter make_decoder uses for a single value, else None
+        if 'Type' not in d or d.get('Number') not in ('0', '1'):
+            return None
+        return VCF.decoders.get(d['Type'], str)
+
+    @staticmethod
+    def make_decoder(d):
+        # parse_value with the descriptor's Type and Number baked in
+        if 'Type' not in d or 'Number' not in d:
+            return functools.partial(VCF.parse_value, d)
+        cvt = VCF.scalar_converter(d)
+        if cvt is not None:
+            return functools.partial(decode_scalar, cvt)
+        cvt = VCF.decoders.get(d['Type'], str)
+        return functools.partial(decode_list, cvt)
+
+    @staticmethod
+    def parse_field(desc, kv):
+        k,v = kv
+        d = desc.get(k)
+        if d is None:
+            return (k, v)
+        return (k, VCF.parse_value(d, v))
 
     def parse_info(self, kv):
-        return self.parse_field(self.infos, self.parse_kv(kv))
+        k, eq, v = kv.partition('=')
+        f = self.info_decoders.get(k)
+        if not eq:
+            v = True
+        return (k, v) if f is None else (k, f(v))
 
     def parse_sample(self, kv):
         return self.parse_field(self.formats, kv)
 
+    def split_format(self, fmt):
+        # FORMAT keys with their decoders and scalar converters, shared
+        # by the rows that repeat the same FORMAT string
+        r = self.format_keys.get(fmt)
+        if r is None:
+            if len(self.format_keys) >= 4096:
+                self.format_keys.clear()
+            fmts = [] if fmt == '.' else fmt.split(':')
+            r = (fmts, [self.format_decoders.get(k) for k in fmts],
+                [self.format_scalar_cvts.get(k) for k in fmts])
+            self.format_keys[fmt] = r
+        return r
+
+    def parse_samples(self, fmts, vals, decs, cvts):
+        # FORMAT is shared by all the samples of the row, so are decs
+        # and cvts, as returned by split_format
+        rows = [val.split(':') for val in vals]
+        n = len(fmts)
+        if n == 0 or any(len(r) != n for r in rows):
+            # some samples drop trailing fields, decode them one by one
+            return [dict(zip(fmts, [v if f is None else f(v)
+                for f, v in zip(decs, r)])) for r in rows]
+        # decode column by column, so that a column of plain scalars
+        # goes through a single C-level map
+        cols = []
+        for f, cvt, col in zip(decs, cvts, zip(*rows)):
+            if f is None:
+                pass
+            elif cvt is not None and '.' not in col:
+                if cvt is not str:
+                    col = list(map(cvt, col))
+            else:
+                col = list(map(f, col))
+            cols.append(col)
+        return [dict(zip(fmts, r)) for r in zip(*cols)]
+
     def parse(self, line):
         vals = line.split('\t')
-        if len(vals) < 8 or vals[7] == '.':
-            info = {}
-        else:
-            info = dict(map(self.parse_info, vals[7].split(';')))
-        if len(vals) < 9 or vals[8] == '.':
-            fmts = []
-        else:
-            fmts = vals[8].split(':')
+        info = {}
+        if len(vals) >= 8 and vals[7] != '.':
+            # parse_info inlined, this runs for every INFO entry
+            decs = self.info_decoders
+            for kv in vals[7].split(';'):
+                k, eq, v = kv.partition('=')
+                f = decs.get(k)
+                if not eq:
+                    v = True
+                info[k] = v if f is None else f(v)
         samples = []
-        for val in vals[9:]:
-            s = dict(map(self.parse_sample, izip(fmts,val.split(':'))))
-            samples.append(s)
+        if len(vals) > 9:
+            fmts, decs, cvts = self.split_format(vals[8])
+            samples = self.parse_samples(fmts, vals[9:], decs, cvts)
         vals[1] = int(vals[1])-1
         vals[4] = vals[4].split(',') if vals[4] != '.' else []
         vals[5] = float(vals[5]) if vals[5] != '.' else None
@@ -219,10 +378,10 @@ class VCF(sharder.Shardable):
 
     @staticmethod
     def genotypes(a, p):
-        if len(a) == 1:
-            return (a * p, )
-        a, b = a[:-1], a[-1:]
-        return [g + b*k for k in xrange(p+1) for g in VCF.genotypes(a, p-k)]
+        # VCF order is colex: combinations of the reversed alleles, read
+        # backwards, with each genotype reversed back
+        g = list(itertools.combinations_with_replacement(a[::-1], p))
+        return [list(reversed(c)) for c in reversed(g)]
 
     @staticmethod
     def sort_field(desc, alt, kv):
@@ -232,10 +391,10 @@ class VCF(sharder.Shardable):
             return kv
         if d['Number'] == '.' and len(v) == len(alt)+1 or d['Number'] == 'R':
             a = ['R'] + alt
-            return (k, [e for _,e in sorted(izip(a,v))])
+            return (k, [e for _,e in sorted(zip(a,v))])
         if d['Number'] == 'A':
             a = alt
-            return (k, [e for _,e in sorted(izip(a,v))])
+            return (k, [e for _,e in sorted(zip(a,v))])
         if d['Number'] == 'G':
             a = ['R'] + alt
             ploidy, glsize = 2, len(a)*(len(a)+1)/2
@@ -255,7 +414,7 @@ class VCF(sharder.Shardable):
                 glsize = len(a)
                 assert glsize == len(v)
                 g = a
-            return (k, [e for _,e in sorted(izip(g,v))])
+            return (k, [e for _,e in sorted(zip(g,v))])
         return kv
 
     def sort_info(self, alt, kv):
@@ -264,20 +423,36 @@ class VCF(sharder.Shardable):
     def sort_sample(self, alt, kv):
         return self.sort_field(self.formats, alt, kv)
 
+    @staticmethod
+    def format_value(d, v):
+        cvt = VCF.encoders.get(d['Type'], str)
+        if v is None:
+            return '.'
+        elif d['Number'] == '0':
+            return None
+        elif d['Number'] == '1':
+            return cvt(v)
+        return ','.join(map(cvt, v))
+
+    @staticmethod
+    def make_encoder(d):
+        # format_value with the descriptor's Type and Number baked in
+        if 'Type' not in d or 'Number' not in d:
+            return functools.partial(VCF.format_value, d)
+        cvt = VCF.encoders.get(d['Type'], str)
+        if d['Number'] == '0':
+            return encode_flag
+        elif d['Number'] == '1':
+            return functools.partial(encode_scalar, cvt)
+        return functools.partial(encode_list, cvt)
+
     @staticmethod
     def format_field(desc, kv):
         k,v = kv
         d = desc.get(k)
         if d is None:
             return (k,str(v))
-        cvt = VCF.encoders.get(d['Type'], str)
-        if v is None:
-            return (k,'.')
-        elif d['Number'] == '0':
-            return (k,None)
-        elif d['Number'] == '1':
-            return (k,cvt(v))
-        return (k,','.join(map(cvt, v)))
+        return (k,VCF.format_value(d, v))
 
     def format_info(self, kv):
         return self.format_field(self.infos, kv)
@@ -285,20 +460,40 @@ class VCF(sharder.Shardable):
     def format_sample(self, kv):
         return self.format_field(self.formats, kv)
 
+    def sorted_keys(self, keys, first=()):
+        # adjacent records mostly repeat the same keys, sort each set once
+        order = self.key_orders.get(keys)
+        if order is None:
+            if len(self.key_orders) >= 4096:
+                self.key_orders.clear()
+            order = list(first) + sorted(k for k in keys if k not in first)
+            self.key_orders[keys] = order
+        return order
+
+    def info_order(self, info):
+        return self.sorted_keys(tuple(info))
+
+    def format_order(self, samples):
+        return self.sorted_keys(frozenset().union(*samples), ('GT',))
+
     def format(self, v):
-        flds = [v.chrom, str(v.pos+1), v.id, v.ref, ','.join(v.alt) or '.',
-            v.qual is not None and ('%4.2f' % v.qual) or '.',
-            ';'.join(v.filter) or '.']
-        t = [self.format_info(kv) for kv in sorted(v.info.items())]
-        f = lambda kv: kv[1] is None and kv[0] or '='.join(kv)
-        flds.append(';'.join(map(f, t)) or '.')
+        flds = [v.chrom, str(v.pos+1), v.id, v.ref,
+            ','.join(v.alt) if v.alt else '.',
+            '.' if v.qual is None else '%4.2f' % v.qual,
+            ';'.join(v.filter) if v.filter else '.']
+        info, encs = v.info, self.info_encoders
+        t = []
+        for k in self.info_order(info):
+            x = encs.get(k, str)(info[k])
+            t.append(k if x is None else k + '=' + x)
+        flds.append(';'.join(t) if t else '.')
         if len(self.samples) > 0:
-            keys = set(itertools.chain(*[iterkeys(s) for s in v.samples]))
-            keys.discard('GT'); keys = ['GT'] + sorted(keys)
+            keys = self.format_order(v.samples)
             flds.append(':'.join(keys))
+            encs = [self.format_encoders.get(k, str) for k in keys]
+            kes = list(zip(keys, encs))
             for s in v.samples:
-                t = [self.format_sample((k,s.get(k)))[1] for k in keys]
-                flds.append(':'.join(t))
+                flds.append(':'.join([e(s.get(k)) for k,e in kes]))
         t, v.line = v.line, '\t'.join(flds)
         return t
 
@@ -307,17 +502,25 @@ class VCF(sharder.Shardable):
         return self
 
     def __next__(self):
-        line = self.fp.readline().decode()
-        while line.startswith('#'):
-            line = self.fp.readline().decode()
-        if len(line) == 0:
+        # the header is behind initoff and index offsets point at records,
+        # so no '#' lines come through here
+        line = self.fp.readline()
+        if not line:
             raise StopIteration
-        line = line.rstrip()
+        # strip the raw bytes so only the record itself gets decoded
+        raw = line
+        line = raw.rstrip()
+        if self.keep_raw and (len(line) + 1 != len(raw) or
+            raw[-1:] != b'\n'):
+            raw = line + b'\n'
+        line = line.decode()
         try:
             v = self.parse(line)
         except ValueError as e:
             e.args += (line,)
             raise
+        if self.keep_raw:
+            v.raw = (line, raw)
         return v
 
     next = __next__
@@ -325,20 +528,23 @@ class VCF(sharder.Shardable):
     def range(self, chrom, start=0, end=0x7fffffff):
         return VCFReader(self, chrom, start, end)
 
-    def emit(self, v):
+    def line_bytes(self, v):
+        # the bytes read for v are still good as long as its line is
+        if v.raw is not None and v.raw[0] is v.line:
+            return v.raw[1]
         if v.line is None:
             self.format(v)
-        self.fp.write(v.line.encode() + b'\n')
+        return v.line.encode() + b'\n'
+
+    def emit(self, v):
+        self.fp.write(self.line_bytes(v))
         if self.index is not None:
             self.index.add(v.chrom, v.pos, v.end, self.fp.tell())
 
     def cmp_variants(self, v1, v2):
-        v1_contig_idx = list(self.contigs.keys()).index(v1.chrom)
-        v2_contig_idx = list(self.contigs.keys()).index(v2.chrom)
-        if not cmp(v1_contig_idx, v2_contig_idx):
-            return cmp(v1_contig_idx, v2_contig_idx)
-        else:
-            return cmp(v1.pos, v2.pos)
+        order = self.contig_order
+        return (cmp(order[v1.chrom], order[v2.chrom]) or
+            cmp(v1.pos, v2.pos))
 
     def close(self):
         if self.fp is not None:
@@ -360,18 +566,22 @@ class VCF(sharder.Shardable):
         if tmpf is None:
             return
         tfp = io.open(tmpf, 'rb')
+        key, chrom = None, None
         for line in tfp:
-            flds = line.decode().rstrip().split('\t')
-            chrom = flds[0]
+            # stay in bytes and leave the sample columns unsplit, only
+            # the contig name is needed as str
+            flds = line.split(b'\t', 8)
+            if flds[0] != key:
+                key, chrom = flds[0], flds[0].decode()
             pos = int(flds[1])-1
             end = pos + len(flds[3])
             if len(flds) > 7:
-                info = flds[7]
-                i = info.find('END=')
-                while i > 0 and info[i-1] != ';':
-                    i = info.find('END=', i+4)
+                info = flds[7].rstrip()
+                i = info.find(b'END=')
+                while i > 0 and info[i-1:i] != b';':
+                    i = info.find(b'END=', i+4)
                 if i >= 0:
-                    end = int(info[i+4:].split(';',1)[0])
+                    end = int(info[i+4:].split(b';',1)[0])
             self.fp.write(line)
             if self.index is not None:
                 self.index.add(chrom, pos, end, self.fp.tell())
@@ -452,9 +662,7 @@ class VCFWriter(sharder.ShardResult):
     def emit(self, v):
         if v.chrom != self.chrom or v.pos >= self.end or v.end <= self.start:
             return
-        if v.line is None:
-            self.vcf.format(v)
-        self.fp.write(v.line.encode() + b'\n')
+        self.fp.write(self.vcf.line_bytes(v))
 
     def close(self):
         self.fp.close()